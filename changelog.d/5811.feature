@@ -0,0 +1 @@
+Add a `gzip_level` config option to set the compression level used for HTTP responses, and compress large responses on a background thread. Note that the default level is now 1 rather than 9, which makes compressed responses larger. Set `gzip_level: 9` to keep the old behaviour.
@@ -0,0 +1 @@
+Allow the startup dependency check to be skipped by setting the `SYNAPSE_SKIP_DEPENDENCY_CHECK` environment variable to `1`.
@@ -21,8 +21,7 @@ import gc
 import logging
 import os
 import sys
-
-from six import iteritems
+from collections import OrderedDict
 
 import psutil
 from prometheus_client import Gauge
@@ -31,8 +30,6 @@ from twisted.application import service
 from twisted.internet import defer, reactor
 from twisted.python.failure import Failure
 from twisted.web.resource import EncodingResourceWrapper, NoResource
-from twisted.web.server import GzipEncoderFactory
-from twisted.web.static import File
 
 import synapse
 import synapse.config.logger
@@ -50,26 +47,25 @@ from synapse.app import _base
 from synapse.app._base import listen_ssl, listen_tcp, quit_with_error
 from synapse.config._base import ConfigError
 from synapse.config.homeserver import HomeServerConfig
-from synapse.federation.transport.server import TransportLayerServer
 from synapse.http.additional_resource import AdditionalResource
+from synapse.http.compression import ThreadedGzipEncoderFactory
 from synapse.http.server import RootRedirect
 from synapse.http.site import SynapseSite
-from synapse.logging.context import LoggingContext
-from synapse.metrics import METRICS_PREFIX, MetricsResource, RegistryProxy
+from synapse.http.static import ScandirFile
+from synapse.logging.context import (
+    LoggingContext,
+    make_deferred_yieldable,
+    run_in_background,
+)
 from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.module_api import ModuleApi
 from synapse.python_dependencies import check_requirements
-from synapse.replication.http import REPLICATION_PREFIX, ReplicationRestResource
 from synapse.replication.tcp.resource import ReplicationStreamProtocolFactory
-from synapse.rest import ClientRestResource
-from synapse.rest.admin import AdminRestResource
-from synapse.rest.key.v2 import KeyApiV2Resource
-from synapse.rest.media.v0.content_repository import ContentRepoResource
-from synapse.rest.well_known import WellKnownResource
 from synapse.server import HomeServer
 from synapse.storage import DataStore, are_all_users_on_domain
 from synapse.storage.engines import IncorrectDatabaseSetup, create_engine
 from synapse.storage.prepare_database import UpgradeDatabaseException, prepare_database
+from synapse.util import unwrapFirstError
 from synapse.util.caches import CACHE_SIZE_FACTOR
 from synapse.util.httpresourcetree import create_resource_tree
 from synapse.util.manhole import manhole
@@ -79,14 +75,24 @@ from synapse.util.versionstring import get_version_string
 
 logger = logging.getLogger("synapse.app.homeserver")
 
+_STATIC_DIR = os.path.join(os.path.dirname(synapse.__file__), "static")
+
 
-def gz_wrap(r):
-    return EncodingResourceWrapper(r, [GzipEncoderFactory()])
+def gz_wrap(r, encoders):
+    return EncodingResourceWrapper(r, encoders)
 
 
 class SynapseHomeServer(HomeServer):
     DATASTORE_CLASS = DataStore
 
+    # resources which are shared between all the listeners that include them,
+    # built on first use.
+    _static_resource = None
+    _gzip_encoders = None
+    _transport_layer = None
+    _openid_transport_layer = None
+    _media_repo_resources = None
+
     def _listener_http(self, config, listener_config):
         port = listener_config["port"]
         bind_addresses = listener_config["bind_addresses"]
@@ -95,14 +101,15 @@ class SynapseHomeServer(HomeServer):
 
         resources = {}
         for res in listener_config["resources"]:
-            for name in res["names"]:
-                if name == "openid" and "federation" in res["names"]:
-                    # Skip loading openid resource if federation is defined
-                    # since federation resource will include openid
-                    continue
-                resources.update(
-                    self._configure_named_resource(name, res.get("compress", False))
-                )
+            # dedupe the names, but keep them in the order they were configured in
+            names = OrderedDict.fromkeys(res["names"])
+            compress = res.get("compress", False)
+            if "federation" in names:
+                # Skip loading openid resource if federation is defined
+                # since federation resource will include openid
+                names.pop("openid", None)
+            for name in names:
+                resources.update(self._configure_named_resource(name, compress))
 
         additional_resources = listener_config.get("additional_resources", {})
         logger.debug("Configuring additional resources: %r", additional_resources)
@@ -112,7 +119,11 @@ class SynapseHomeServer(HomeServer):
             handler = handler_cls(config, module_api)
             resources[path] = AdditionalResource(self, handler.handle_request)
 
-        # try to find something useful to redirect '/' to
+        # try to find something useful to redirect '/' to.
+        #
+        # Note that create_resource_tree attaches this listener's resources to
+        # the root resource, so each listener needs a root of its own: it would
+        # not be safe to share a single NoResource between them.
         if WEB_CLIENT_PREFIX in resources:
             root_resource = RootRedirect(WEB_CLIENT_PREFIX)
         elif STATIC_PREFIX in resources:
@@ -167,96 +178,186 @@ class SynapseHomeServer(HomeServer):
             dict[str, Resource]: map from path to HTTP resource
         """
         resources = {}
-        if name == "client":
-            client_resource = ClientRestResource(self)
-            if compress:
-                client_resource = gz_wrap(client_resource)
-
-            resources.update(
-                {
-                    "/_matrix/client/api/v1": client_resource,
-                    "/_matrix/client/r0": client_resource,
-                    "/_matrix/client/unstable": client_resource,
-                    "/_matrix/client/v2_alpha": client_resource,
-                    "/_matrix/client/versions": client_resource,
-                    "/.well-known/matrix/client": WellKnownResource(self),
-                    "/_synapse/admin": AdminRestResource(self),
-                }
-            )
+        for builder in self._RESOURCE_BUILDERS.get(name, ()):
+            resources.update(builder(self, compress))
+        return resources
 
-            if self.get_config().saml2_enabled:
-                from synapse.rest.saml2 import SAML2Resource
+    def _build_client_resources(self, compress):
+        from synapse.rest import ClientRestResource
+        from synapse.rest.admin import AdminRestResource
+        from synapse.rest.well_known import WellKnownResource
 
-                resources["/_matrix/saml2"] = SAML2Resource(self)
+        client_resource = ClientRestResource(self)
+        if compress:
+            client_resource = gz_wrap(client_resource, self._get_gzip_encoders())
 
-        if name == "consent":
-            from synapse.rest.consent.consent_resource import ConsentResource
+        resources = {
+            "/_matrix/client/api/v1": client_resource,
+            "/_matrix/client/r0": client_resource,
+            "/_matrix/client/unstable": client_resource,
+            "/_matrix/client/v2_alpha": client_resource,
+            "/_matrix/client/versions": client_resource,
+            "/.well-known/matrix/client": WellKnownResource(self),
+            "/_synapse/admin": AdminRestResource(self),
+        }
 
-            consent_resource = ConsentResource(self)
-            if compress:
-                consent_resource = gz_wrap(consent_resource)
-            resources.update({"/_matrix/consent": consent_resource})
+        if self.get_config().saml2_enabled:
+            from synapse.rest.saml2 import SAML2Resource
 
-        if name == "federation":
-            resources.update({FEDERATION_PREFIX: TransportLayerServer(self)})
+            resources["/_matrix/saml2"] = SAML2Resource(self)
 
-        if name == "openid":
-            resources.update(
-                {
-                    FEDERATION_PREFIX: TransportLayerServer(
-                        self, servlet_groups=["openid"]
-                    )
-                }
-            )
+        return resources
 
-        if name in ["static", "client"]:
-            resources.update(
-                {
-                    STATIC_PREFIX: File(
-                        os.path.join(os.path.dirname(synapse.__file__), "static")
-                    )
-                }
+    def _build_consent_resources(self, compress):
+        from synapse.rest.consent.consent_resource import ConsentResource
+
+        consent_resource = ConsentResource(self)
+        if compress:
+            consent_resource = gz_wrap(consent_resource, self._get_gzip_encoders())
+        return {"/_matrix/consent": consent_resource}
+
+    def _build_federation_resources(self, compress):
+        return {FEDERATION_PREFIX: self._get_transport_layer()}
+
+    def _build_openid_resources(self, compress):
+        return {FEDERATION_PREFIX: self._get_transport_layer(openid=True)}
+
+    def _build_static_resources(self, compress):
+        return {STATIC_PREFIX: self._get_static_file_resource()}
+
+    def _build_media_resources(self, compress):
+        if not self.get_config().enable_media_repo:
+            raise ConfigError("'media' resource conflicts with enable_media_repo=False")
+        return self._get_media_repo_resources()
+
+    def _build_optional_media_resources(self, compress):
+        # the client and federation resources include the media repo if it is
+        # enabled, but don't insist on it.
+        if not self.get_config().enable_media_repo:
+            return {}
+        return self._get_media_repo_resources()
+
+    def _build_key_resources(self, compress):
+        from synapse.rest.key.v2 import KeyApiV2Resource
+
+        return {SERVER_KEY_V2_PREFIX: KeyApiV2Resource(self)}
+
+    def _build_webclient_resources(self, compress):
+        webclient_path = self.get_config().web_client_location
+
+        if webclient_path is None:
+            logger.warning(
+                "Not enabling webclient resource, as web_client_location is unset."
             )
+            return {}
+
+        # GZip is disabled here due to
+        # https://twistedmatrix.com/trac/ticket/7678
+        return {WEB_CLIENT_PREFIX: ScandirFile(webclient_path)}
+
+    def _build_metrics_resources(self, compress):
+        if not self.get_config().enable_metrics:
+            return {}
+
+        from synapse.metrics import METRICS_PREFIX, MetricsResource, RegistryProxy
+
+        return {METRICS_PREFIX: MetricsResource(RegistryProxy)}
+
+    def _build_replication_resources(self, compress):
+        from synapse.replication.http import REPLICATION_PREFIX, ReplicationRestResource
+
+        return {REPLICATION_PREFIX: ReplicationRestResource(self)}
+
+    # map from resource name to the builders which provide its part of the
+    # resource tree. Each builder is called with the homeserver and the
+    # `compress` setting, and returns a map from path to HTTP resource.
+    _RESOURCE_BUILDERS = {
+        "client": [
+            _build_client_resources,
+            _build_static_resources,
+            _build_optional_media_resources,
+        ],
+        "consent": [_build_consent_resources],
+        "federation": [
+            _build_federation_resources,
+            _build_optional_media_resources,
+            _build_key_resources,
+        ],
+        "openid": [_build_openid_resources],
+        "static": [_build_static_resources],
+        "media": [_build_media_resources],
+        "keys": [_build_key_resources],
+        "webclient": [_build_webclient_resources],
+        "metrics": [_build_metrics_resources],
+        "replication": [_build_replication_resources],
+    }
+
+    def _get_static_file_resource(self):
+        """Get the resource which serves synapse's bundled static content
 
-        if name in ["media", "federation", "client"]:
-            if self.get_config().enable_media_repo:
-                media_repo = self.get_media_repository_resource()
-                resources.update(
-                    {
-                        MEDIA_PREFIX: media_repo,
-                        LEGACY_MEDIA_PREFIX: media_repo,
-                        CONTENT_REPO_PREFIX: ContentRepoResource(
-                            self, self.config.uploads_path
-                        ),
-                    }
-                )
-            elif name == "media":
-                raise ConfigError(
-                    "'media' resource conflicts with enable_media_repo=False"
-                )
+        Returns:
+            ScandirFile
+        """
+        if self._static_resource is None:
+            self._static_resource = ScandirFile(_STATIC_DIR)
+        return self._static_resource
 
-        if name in ["keys", "federation"]:
-            resources[SERVER_KEY_V2_PREFIX] = KeyApiV2Resource(self)
+    def _get_gzip_encoders(self):
+        """Get the encoder factories used to gzip responses
 
-        if name == "webclient":
-            webclient_path = self.get_config().web_client_location
+        The factories hold no per-request state, so they can be shared by every
+        resource we wrap.
 
-            if webclient_path is None:
-                logger.warning(
-                    "Not enabling webclient resource, as web_client_location is unset."
+        Returns:
+            list[ThreadedGzipEncoderFactory]
+        """
+        if self._gzip_encoders is None:
+            self._gzip_encoders = [
+                ThreadedGzipEncoderFactory(self.get_reactor(), self.config.gzip_level)
+            ]
+        return self._gzip_encoders
+
+    def _get_transport_layer(self, openid=False):
+        """Get the resource which serves the federation API
+
+        Args:
+            openid (bool): if True, get a resource which only serves the openid
+                userinfo endpoint, rather than the whole federation API.
+
+        Returns:
+            TransportLayerServer
+        """
+        from synapse.federation.transport.server import TransportLayerServer
+
+        if openid:
+            if self._openid_transport_layer is None:
+                self._openid_transport_layer = TransportLayerServer(
+                    self, servlet_groups=["openid"]
                 )
-            else:
-                # GZip is disabled here due to
-                # https://twistedmatrix.com/trac/ticket/7678
-                resources[WEB_CLIENT_PREFIX] = File(webclient_path)
+            return self._openid_transport_layer
 
-        if name == "metrics" and self.get_config().enable_metrics:
-            resources[METRICS_PREFIX] = MetricsResource(RegistryProxy)
+        if self._transport_layer is None:
+            self._transport_layer = TransportLayerServer(self)
+        return self._transport_layer
 
-        if name == "replication":
-            resources[REPLICATION_PREFIX] = ReplicationRestResource(self)
+    def _get_media_repo_resources(self):
+        """Get the resources which serve the media repository
 
-        return resources
+        Returns:
+            dict[str, Resource]: map from path to HTTP resource
+        """
+        if self._media_repo_resources is None:
+            from synapse.rest.media.v0.content_repository import ContentRepoResource
+
+            media_repo = self.get_media_repository_resource()
+            self._media_repo_resources = {
+                MEDIA_PREFIX: media_repo,
+                LEGACY_MEDIA_PREFIX: media_repo,
+                CONTENT_REPO_PREFIX: ContentRepoResource(
+                    self, self.config.uploads_path
+                ),
+            }
+        return self._media_repo_resources
 
     def start_listening(self, listeners):
         config = self.get_config()
@@ -358,6 +459,9 @@ def setup(config_options):
 
     logger.info("Preparing database: %s...", config.database_config["name"])
 
+    # This is done synchronously, before the reactor starts, on purpose: the
+    # datastores built by hs.setup() read from the database as they are
+    # constructed, and nothing can be served until the schema is up to date.
     try:
         with hs.get_db_conn(run_new_connection=False) as db_conn:
             prepare_database(db_conn, database_engine, config=config)
@@ -472,42 +576,28 @@ class SynapseService(service.Service):
 
 
 def run(hs):
-    PROFILE_SYNAPSE = False
-    if PROFILE_SYNAPSE:
-
-        def profile(func):
-            from cProfile import Profile
-            from threading import current_thread
-
-            def profiled(*args, **kargs):
-                profile = Profile()
-                profile.enable()
-                func(*args, **kargs)
-                profile.disable()
-                ident = current_thread().ident
-                profile.dump_stats(
-                    "/tmp/%s.%s.%i.pstat" % (hs.hostname, func.__name__, ident)
-                )
-
-            return profiled
+    clock = hs.get_clock()
+    start_time = clock.time()
 
-        from twisted.python.threadpool import ThreadPool
+    def aligned_looping_call(f, msec, *args):
+        """Call `f(*args)` every `msec` milliseconds, starting at the next multiple
+        of `msec` since the epoch.
 
-        ThreadPool._worker = profile(ThreadPool._worker)
-        reactor.run = profile(reactor.run)
+        Tasks running at the same or dividing periods then wake the reactor at
+        the same moments rather than at arbitrary offsets from startup.
+        """
 
-    clock = hs.get_clock()
-    start_time = clock.time()
+        def start():
+            f(*args)
+            clock.looping_call(f, msec, *args)
 
-    stats = {}
+        period = msec / 1000
+        clock.call_later(period - (clock.time() % period), start)
 
     # Contains the list of processes we will be monitoring
     # currently either 0 or 1
     stats_process = []
 
-    def start_phone_stats_home():
-        return run_as_background_process("phone_stats_home", phone_stats_home)
-
     @defer.inlineCallbacks
     def phone_stats_home():
         logger.info("Gathering stats for reporting")
@@ -516,52 +606,74 @@ def run(hs):
         if uptime < 0:
             uptime = 0
 
-        stats["homeserver"] = hs.config.server_name
-        stats["server_context"] = hs.config.server_context
-        stats["timestamp"] = now
-        stats["uptime_seconds"] = uptime
         version = sys.version_info
-        stats["python_version"] = "{}.{}.{}".format(
-            version.major, version.minor, version.micro
-        )
-        stats["total_users"] = yield hs.get_datastore().count_all_users()
-
-        total_nonbridged_users = yield hs.get_datastore().count_nonbridged_users()
-        stats["total_nonbridged_users"] = total_nonbridged_users
-
-        daily_user_type_results = yield hs.get_datastore().count_daily_user_type()
-        for name, count in iteritems(daily_user_type_results):
-            stats["daily_user_type_" + name] = count
-
-        room_count = yield hs.get_datastore().get_room_count()
-        stats["total_room_count"] = room_count
-
-        stats["daily_active_users"] = yield hs.get_datastore().count_daily_users()
-        stats["monthly_active_users"] = yield hs.get_datastore().count_monthly_users()
-        stats[
-            "daily_active_rooms"
-        ] = yield hs.get_datastore().count_daily_active_rooms()
-        stats["daily_messages"] = yield hs.get_datastore().count_daily_messages()
-
-        r30_results = yield hs.get_datastore().count_r30_users()
-        for name, count in iteritems(r30_results):
-            stats["r30_users_" + name] = count
+        store = hs.get_datastore()
 
-        daily_sent_messages = yield hs.get_datastore().count_daily_sent_messages()
-        stats["daily_sent_messages"] = daily_sent_messages
-        stats["cache_factor"] = CACHE_SIZE_FACTOR
-        stats["event_cache_size"] = hs.config.event_cache_size
+        # the counts are independent of each other, so run them in parallel.
+        (
+            total_users,
+            total_nonbridged_users,
+            daily_user_type_results,
+            room_count,
+            daily_active_users,
+            monthly_active_users,
+            daily_active_rooms,
+            daily_messages,
+            r30_results,
+            daily_sent_messages,
+        ) = yield make_deferred_yieldable(
+            defer.gatherResults(
+                [
+                    run_in_background(store.count_all_users),
+                    run_in_background(store.count_nonbridged_users),
+                    run_in_background(store.count_daily_user_type),
+                    run_in_background(store.get_room_count),
+                    run_in_background(store.count_daily_users),
+                    run_in_background(store.count_monthly_users),
+                    run_in_background(store.count_daily_active_rooms),
+                    run_in_background(store.count_daily_messages),
+                    run_in_background(store.count_r30_users),
+                    run_in_background(store.count_daily_sent_messages),
+                ],
+                consumeErrors=True,
+            ).addErrback(unwrapFirstError)
+        )
 
+        process_stats = {}
         if len(stats_process) > 0:
-            stats["memory_rss"] = 0
-            stats["cpu_average"] = 0
+            memory_rss = 0
+            cpu_average = 0
             for process in stats_process:
-                stats["memory_rss"] += process.memory_info().rss
-                stats["cpu_average"] += int(process.cpu_percent(interval=None))
+                memory_rss += process.memory_info().rss
+                cpu_average += int(process.cpu_percent(interval=None))
+            process_stats = {"memory_rss": memory_rss, "cpu_average": cpu_average}
+
+        stats = {
+            "homeserver": hs.config.server_name,
+            "server_context": hs.config.server_context,
+            "timestamp": now,
+            "uptime_seconds": uptime,
+            "python_version": "{}.{}.{}".format(
+                version.major, version.minor, version.micro
+            ),
+            "total_users": total_users,
+            "total_nonbridged_users": total_nonbridged_users,
+            "total_room_count": room_count,
+            "daily_active_users": daily_active_users,
+            "monthly_active_users": monthly_active_users,
+            "daily_active_rooms": daily_active_rooms,
+            "daily_messages": daily_messages,
+            "daily_sent_messages": daily_sent_messages,
+            "cache_factor": CACHE_SIZE_FACTOR,
+            "event_cache_size": hs.config.event_cache_size,
+            "database_engine": store.database_engine_name,
+            "database_server_version": store.get_server_version(),
+            **{"daily_user_type_" + n: c for n, c in daily_user_type_results.items()},
+            **{"r30_users_" + n: c for n, c in r30_results.items()},
+            **process_stats,
+        }
+        logger.info("Reporting stats to matrix.org: %s", stats)
 
-        stats["database_engine"] = hs.get_datastore().database_engine_name
-        stats["database_server_version"] = hs.get_datastore().get_server_version()
-        logger.info("Reporting stats to matrix.org: %s" % (stats,))
         try:
             yield hs.get_simple_http_client().put_json(
                 "https://matrix.org/report-usage-stats/push", stats
@@ -581,24 +693,26 @@ def run(hs):
         except (AttributeError):
             logger.warning("Unable to read memory/cpu stats. Disabling reporting.")
 
-    def generate_user_daily_visit_stats():
-        return run_as_background_process(
-            "generate_user_daily_visits", hs.get_datastore().generate_user_daily_visits
-        )
-
     # Rather than update on per session basis, batch up the requests.
     # If you increase the loop period, the accuracy of user_daily_visits
     # table will decrease
-    clock.looping_call(generate_user_daily_visit_stats, 5 * 60 * 1000)
+    aligned_looping_call(
+        run_as_background_process,
+        5 * 60 * 1000,
+        "generate_user_daily_visits",
+        hs.get_datastore().generate_user_daily_visits,
+    )
 
     # monthly active user limiting functionality
-    def reap_monthly_active_users():
-        return run_as_background_process(
-            "reap_monthly_active_users", hs.get_datastore().reap_monthly_active_users
-        )
-
-    clock.looping_call(reap_monthly_active_users, 1000 * 60 * 60)
-    reap_monthly_active_users()
+    aligned_looping_call(
+        run_as_background_process,
+        1000 * 60 * 60,
+        "reap_monthly_active_users",
+        hs.get_datastore().reap_monthly_active_users,
+    )
+    run_as_background_process(
+        "reap_monthly_active_users", hs.get_datastore().reap_monthly_active_users
+    )
 
     @defer.inlineCallbacks
     def generate_monthly_active_users():
@@ -612,19 +726,28 @@ def run(hs):
         registered_reserved_users_mau_gauge.set(float(reserved_count))
         max_mau_gauge.set(float(hs.config.max_mau_value))
 
-    def start_generate_monthly_active_users():
-        return run_as_background_process(
-            "generate_monthly_active_users", generate_monthly_active_users
-        )
-
-    start_generate_monthly_active_users()
+    run_as_background_process(
+        "generate_monthly_active_users", generate_monthly_active_users
+    )
     if hs.config.limit_usage_by_mau or hs.config.mau_stats_only:
-        clock.looping_call(start_generate_monthly_active_users, 5 * 60 * 1000)
+        aligned_looping_call(
+            run_as_background_process,
+            5 * 60 * 1000,
+            "generate_monthly_active_users",
+            generate_monthly_active_users,
+        )
     # End of monthly active user settings
 
     if hs.config.report_stats:
         logger.info("Scheduling stats reporting for 3 hour intervals")
-        clock.looping_call(start_phone_stats_home, 3 * 60 * 60 * 1000)
+        # Not aligned like the tasks above: that would have every homeserver
+        # reporting to matrix.org at the same moment.
+        clock.looping_call(
+            run_as_background_process,
+            3 * 60 * 60 * 1000,
+            "phone_stats_home",
+            phone_stats_home,
+        )
 
         # We need to defer this init for the cases that we daemonize
         # otherwise the process ID we get is that of the non-daemon process
@@ -632,7 +755,9 @@ def run(hs):
 
         # We wait 5 minutes to send the first set of stats as the server can
         # be quite busy the first few minutes
-        clock.call_later(5 * 60, start_phone_stats_home)
+        clock.call_later(
+            5 * 60, run_as_background_process, "phone_stats_home", phone_stats_home
+        )
 
     _base.start_reactor(
         "synapse-homeserver",
@@ -254,6 +254,14 @@ class ServerConfig(Config):
 
         self.gc_thresholds = read_gc_thresholds(config.get("gc_thresholds", None))
 
+        self.gzip_level = config.get("gzip_level", 1)
+        if (
+            isinstance(self.gzip_level, bool)
+            or not isinstance(self.gzip_level, int)
+            or not 1 <= self.gzip_level <= 9
+        ):
+            raise ConfigError("gzip_level must be an integer between 1 and 9")
+
         @attr.s
         class LimitRemoteRoomsConfig(object):
             enabled = attr.ib(
@@ -443,6 +451,13 @@ class ServerConfig(Config):
         #
         #gc_thresholds: [700, 10, 10]
 
+        # The compression level to use for resources which have 'compress'
+        # enabled (see 'listeners', below), from 1 (fastest) to 9 (smallest
+        # responses). The default is 1; versions of Synapse before this option
+        # was added always used 9.
+        #
+        #gzip_level: 1
+
         # Set the limit on the returned events in the timeline in the get
         # and sync operations. The default value is -1, means no upper limit.
         #
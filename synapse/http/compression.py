@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import zlib
+
+from zope.interface import implementer
+
+from twisted.internet import defer, threads
+from twisted.web import http
+from twisted.web.iweb import _IRequestEncoder
+from twisted.web.server import GzipEncoderFactory
+
+from synapse.logging.context import LoggingContext, PreserveLoggingContext
+
+logger = logging.getLogger(__name__)
+
+# Writes smaller than this are compressed on the reactor thread, since the trip to
+# the threadpool would cost more than compressing them.
+THREADED_COMPRESSION_MIN_SIZE = 32 * 1024
+
+
+class ThreadedGzipEncoderFactory(GzipEncoderFactory):
+    """A replacement for twisted's GzipEncoderFactory which compresses large
+    response bodies on the reactor's threadpool, rather than blocking the reactor
+    while it does so.
+
+    The encoders it returns rely on SynapseRequest to wait for any outstanding
+    compression before finishing the response.
+
+    Args:
+        reactor (twisted.internet.base.ReactorBase): the reactor whose threadpool
+            should be used for compression.
+        level (int): the zlib compression level to use.
+    """
+
+    def __init__(self, reactor, level):
+        self._reactor = reactor
+        self.compressLevel = level
+
+    def encoderForRequest(self, request):
+        """Check the headers if the client accepts gzip encoding, and encodes the
+        request if so.
+        """
+        accept_headers = b",".join(
+            request.requestHeaders.getRawHeaders(b"accept-encoding", [])
+        )
+        if not self._gzipCheckRegex.search(accept_headers):
+            return None
+
+        encoding = request.responseHeaders.getRawHeaders(b"content-encoding")
+        if encoding:
+            encoding = b",".join(encoding + [b"gzip"])
+        else:
+            encoding = b"gzip"
+        request.responseHeaders.setRawHeaders(b"content-encoding", [encoding])
+
+        return ThreadedGzipEncoder(self._reactor, self.compressLevel, request)
+
+
+@implementer(_IRequestEncoder)
+class ThreadedGzipEncoder(object):
+    """A gzip encoder which hands large writes off to the reactor's threadpool.
+
+    Compressed data from the threadpool is written straight to the request, in
+    the order it was passed to `encode`.
+
+    Args:
+        reactor (twisted.internet.base.ReactorBase): the reactor whose threadpool
+            should be used for compression.
+        level (int): the zlib compression level to use.
+        request (twisted.web.server.Request): the request being encoded.
+    """
+
+    def __init__(self, reactor, level, request):
+        self._reactor = reactor
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._request = request
+
+        # A deferred which completes once all the writes handed to the threadpool
+        # so far have been compressed and written to the request, or None if there
+        # are none outstanding.
+        self.pending = None
+        self._pending_count = 0
+
+        # Set once writing out some of the response has failed, and we have dropped
+        # the connection. The request mustn't be finished after that, since the
+        # response would be missing part of its body.
+        self.failed = False
+
+    def encode(self, data):
+        """Compress some data, returning whatever compressed output should be
+        written to the request immediately.
+        """
+        if not self._request.startedWriting:
+            # Remove the content-length header, we can't honor it
+            # because we compress on the fly.
+            self._request.responseHeaders.removeHeader(b"content-length")
+
+        if self.failed:
+            # we've dropped the connection, so there's no point going on.
+            return b""
+
+        if self.pending is None and len(data) < THREADED_COMPRESSION_MIN_SIZE:
+            return self._compressor.compress(data)
+
+        # Either this write is big enough to be worth compressing on the
+        # threadpool, or earlier writes are still there and we need to preserve
+        # the ordering of the output.
+        if self.pending is None:
+            self.pending = defer.succeed(None)
+        self._pending_count += 1
+        self.pending.addCallback(self._compress_in_thread, data)
+        self.pending.addCallback(self._write)
+        self.pending.addErrback(self._on_error)
+
+        return b""
+
+    def finish(self):
+        """Flush any data remaining in the zlib buffer. Must not be called while
+        there are writes outstanding on the threadpool.
+        """
+        remain = self._compressor.flush()
+        self._compressor = None
+        return remain
+
+    def _compress_in_thread(self, _, data):
+        # as with defer_to_threadpool, run the compression in a child of the
+        # request's logcontext, so that the cpu time is charged to it. We can't use
+        # defer_to_threadpool itself, as these callbacks don't run in the request's
+        # logcontext.
+        parent_context = self._request.logcontext
+
+        def _compress():
+            with LoggingContext(parent_context=parent_context):
+                return self._compressor.compress(data)
+
+        return threads.deferToThreadPool(
+            self._reactor, self._reactor.getThreadPool(), _compress
+        )
+
+    def _write(self, compressed):
+        request = self._request
+        if (
+            not self.failed
+            and request.method != b"HEAD"
+            and request.code not in http.NO_BODY_CODES
+        ):
+            # `encode` has already been applied to this data, so bypass
+            # twisted.web.server.Request.write.
+            http.Request.write(request, compressed)
+
+        self._write_done()
+
+    def _on_error(self, failure):
+        self._write_done()
+        if self.failed:
+            return
+        self.failed = True
+
+        with PreserveLoggingContext(self._request.logcontext):
+            logger.error(
+                "Error writing compressed response to %r",
+                self._request,
+                exc_info=(failure.type, failure.value, failure.getTracebackObject()),
+            )
+        # we can't send a response which is missing part of the body.
+        self._request.loseConnection()
+
+    def _write_done(self):
+        self._pending_count -= 1
+        if self._pending_count == 0:
+            self.pending = None
@@ -18,6 +18,7 @@ import time
 from twisted.web.server import Request, Site
 
 from synapse.http import redact_uri
+from synapse.http.compression import ThreadedGzipEncoder
 from synapse.http.request_metrics import RequestMetrics, requests_counter
 from synapse.logging.context import LoggingContext, PreserveLoggingContext
 
@@ -178,12 +179,32 @@ class SynapseRequest(Request):
         Overrides twisted.web.server.Request.finish to record the finish time and do
         logging.
         """
+        if isinstance(self._encoder, ThreadedGzipEncoder):
+            if self._encoder.failed:
+                # the encoder has dropped the connection, since we can't send a
+                # response which is missing part of the body.
+                return
+
+            pending = self._encoder.pending
+            if pending is not None:
+                # the encoder is still compressing earlier writes on the
+                # threadpool: finish once they have been written.
+                pending.addBoth(self._finish_after_encoding)
+                return
+
         self.finish_time = time.time()
         Request.finish(self)
         if not self._is_processing:
             with PreserveLoggingContext(self.logcontext):
                 self._finished_processing()
 
+    def _finish_after_encoding(self, _):
+        if self._disconnected:
+            # connectionLost has already recorded the finish time and done the
+            # logging.
+            return
+        self.finish()
+
     def connectionLost(self, reason):
         """Called when the client connection is closed before the response is written.
 
@@ -366,6 +387,8 @@ class SynapseSite(Site):
         proxied = config.get("x_forwarded", False)
         self.requestFactory = SynapseRequestFactory(self, proxied)
         self.access_logger = logging.getLogger(logger_name)
+        # encoded once here so that each request can set its Server header
+        # without converting it.
         self.server_version_string = server_version_string.encode("ascii")
 
     def log(self, request):
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+
+from twisted.web import http
+from twisted.web.static import File
+
+# Paths containing a long run of hex digits as a path segment or filename
+# component (eg "/bundles/<hash>/vendor.js" or "/app.<hash>.js") are assumed to
+# be named after a hash of their content, so will never change.
+_HASHED_PATH_RE = re.compile(br"[/.-][0-9a-f]{16,}[/.-]")
+
+_IMMUTABLE_CACHE_CONTROL = b"public, max-age=31536000, immutable"
+_DEFAULT_CACHE_CONTROL = b"public, max-age=3600"
+
+
+class CachingFile(File):
+    """A twisted File resource which allows clients to cache the files it serves.
+
+    Responses carry a Cache-Control header, and an ETag derived from the file's
+    modification time and size, so that clients can revalidate with
+    If-None-Match.
+    """
+
+    def render_GET(self, request):
+        self.restat(False)
+        if self.isfile():
+            if _HASHED_PATH_RE.search(request.path):
+                request.setHeader(b"Cache-Control", _IMMUTABLE_CACHE_CONTROL)
+            else:
+                request.setHeader(b"Cache-Control", _DEFAULT_CACHE_CONTROL)
+
+            if request.setETag(self._get_etag()) is http.CACHED:
+                # `setETag` has set the response code for us.
+                return b""
+
+        return File.render_GET(self, request)
+
+    render_HEAD = render_GET
+
+    def _get_etag(self):
+        return b'"%x-%x"' % (int(self.getModificationTime() * 1000000), self.getsize())
+
+
+class ScandirFile(CachingFile):
+    """A CachingFile which lists each directory it serves with a single
+    os.scandir, and reuses the resources for its children, rather than checking
+    the filesystem for each path segment of every request.
+
+    The listing is rebuilt whenever the directory's modification time changes.
+    Names which aren't in the listing are handed to twisted's lookup, so files
+    created since the last listing are still found.
+    """
+
+    _entries = None
+    _entries_mtime = None
+
+    def getChild(self, path, request):
+        if not path or self.processors:
+            # leave directory indexes and processed files to twisted
+            return File.getChild(self, path, request)
+
+        name = path
+        if isinstance(name, bytes):
+            try:
+                name = name.decode("utf-8")
+            except UnicodeDecodeError:
+                return File.getChild(self, path, request)
+
+        entries = self._get_entries()
+        if entries is None or name not in entries:
+            return File.getChild(self, path, request)
+
+        child = self._children.get(name)
+        if child is None:
+            child = self._children[name] = self.createSimilarFile(entries[name])
+        return child
+
+    def _get_entries(self):
+        """Get the entries in this directory.
+
+        Returns:
+            dict[str, str]|None: map from name to path for each entry, or None if
+                this isn't a directory we can list.
+        """
+        if not isinstance(self.path, str):
+            return None
+
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime != self._entries_mtime:
+                self._entries = {e.name: e.path for e in os.scandir(self.path)}
+                self._entries_mtime = mtime
+                self._children = {}
+        except OSError:
+            return None
+
+        return self._entries
@@ -14,14 +14,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+import itertools
 import logging
-
-from pkg_resources import (
-    DistributionNotFound,
-    Requirement,
-    VersionConflict,
-    get_provider,
-)
+import os
 
 logger = logging.getLogger(__name__)
 
@@ -73,6 +69,9 @@ REQUIREMENTS = [
     "Jinja2>=2.9",
     "bleach>=1.4.3",
     "sdnotify>=0.3",
+    # used to check that the other requirements are installed
+    "packaging>=16.1",
+    'importlib_metadata>=1.4;python_version<"3.8"',
 ]
 
 CONDITIONAL_REQUIREMENTS = {
@@ -98,101 +97,162 @@ CONDITIONAL_REQUIREMENTS = {
     "jwt": ["pyjwt>=1.6.4"],
 }
 
-ALL_OPTIONAL_REQUIREMENTS = set()
+# The optional dependencies which aren't included in ALL_OPTIONAL_REQUIREMENTS:
+# systemd is a system-based requirement.
+_EXCLUDED_FROM_ALL = frozenset({"systemd"})
+
+ALL_OPTIONAL_REQUIREMENTS = set().union(
+    *(
+        optional_deps
+        for name, optional_deps in CONDITIONAL_REQUIREMENTS.items()
+        if name not in _EXCLUDED_FROM_ALL
+    )
+)
+
+# Every optional requirement (including systemd's), for check_requirements.
+_ALL_OPTS = tuple(itertools.chain.from_iterable(CONDITIONAL_REQUIREMENTS.values()))
+
 
-for name, optional_deps in CONDITIONAL_REQUIREMENTS.items():
-    # Exclude systemd as it's a system-based requirement.
-    if name not in ["systemd"]:
-        ALL_OPTIONAL_REQUIREMENTS = set(optional_deps) | ALL_OPTIONAL_REQUIREMENTS
+_ALL_REQUIREMENTS = frozenset(REQUIREMENTS) | ALL_OPTIONAL_REQUIREMENTS
 
 
 def list_requirements():
-    return list(set(REQUIREMENTS) | ALL_OPTIONAL_REQUIREMENTS)
+    return list(_ALL_REQUIREMENTS)
 
 
 class DependencyException(Exception):
     @property
     def message(self):
+        dependencies = self.dependencies
         return "\n".join(
             [
-                "Missing Requirements: %s" % (", ".join(self.dependencies),),
+                "Missing Requirements: %s" % (", ".join(dependencies),),
                 "To install run:",
-                "    pip install --upgrade --force %s" % (" ".join(self.dependencies),),
+                "    pip install --upgrade --force %s" % (" ".join(dependencies),),
                 "",
             ]
         )
 
     @property
     def dependencies(self):
-        for i in self.args[0]:
-            yield "'" + i + "'"
+        return ["'" + i + "'" for i in self.args[0]]
+
+
+# The features (or None, for the base requirements) which check_requirements has
+# already found to be satisfied. Failures aren't recorded, so that a check can
+# succeed after the missing dependency is installed.
+_satisfied_features = set()
 
 
 def check_requirements(for_feature=None):
+    # Set by deployments (such as container images) whose dependencies were
+    # already checked when they were built.
+    if os.environ.get("SYNAPSE_SKIP_DEPENDENCY_CHECK") == "1":
+        return
+
+    if for_feature in _satisfied_features:
+        return
+
     deps_needed = []
     errors = []
 
+    parsed_reqs, parsed_conditional_reqs, parsed_opts = _parse_requirements()
+
     if for_feature:
-        reqs = CONDITIONAL_REQUIREMENTS[for_feature]
+        reqs = parsed_conditional_reqs[for_feature]
     else:
-        reqs = REQUIREMENTS
+        reqs = parsed_reqs
 
-    for dependency in reqs:
-        try:
-            _check_requirement(dependency)
-        except VersionConflict as e:
+    # like pkg_resources, we accept pre-releases of a matching version.
+    for dependency, name, specifier in reqs:
+        installed_version = _get_installed_version(name)
+        if installed_version is None:
+            deps_needed.append(dependency)
+            errors.append("Needed %s but it was not installed" % (dependency,))
+        elif not specifier.contains(installed_version, prereleases=True):
             deps_needed.append(dependency)
             errors.append(
-                "Needed %s, got %s==%s"
-                % (dependency, e.dist.project_name, e.dist.version)
+                "Needed %s, got %s==%s" % (dependency, name, installed_version)
             )
-        except DistributionNotFound:
-            deps_needed.append(dependency)
-            errors.append("Needed %s but it was not installed" % (dependency,))
 
     if not for_feature:
         # Check the optional dependencies are up to date. We allow them to not be
         # installed.
-        OPTS = sum(CONDITIONAL_REQUIREMENTS.values(), [])
-
-        for dependency in OPTS:
-            try:
-                _check_requirement(dependency)
-            except VersionConflict as e:
+        for dependency, name, specifier in parsed_opts:
+            installed_version = _get_installed_version(name)
+            if installed_version is not None and not specifier.contains(
+                installed_version, prereleases=True
+            ):
                 deps_needed.append(dependency)
                 errors.append(
                     "Needed optional %s, got %s==%s"
-                    % (dependency, e.dist.project_name, e.dist.version)
+                    % (dependency, name, installed_version)
                 )
-            except DistributionNotFound:
-                # If it's not found, we don't care
-                pass
 
     if deps_needed:
-        for e in errors:
-            logging.error(e)
-
+        logger.error("Dependency check failed:\n%s", "\n".join(errors))
         raise DependencyException(deps_needed)
 
+    _satisfied_features.add(for_feature)
 
-def _check_requirement(dependency_string):
-    """Parses a dependency string, and checks if the specified requirement is installed
 
-    Raises:
-        VersionConflict if the requirement is installed, but with the the wrong version
-        DistributionNotFound if nothing is found to provide the requirement
+@functools.lru_cache(maxsize=None)
+def _parse_requirements():
+    """Parses all of the requirement specifiers, the first time they are needed.
+
+    This isn't done when the file is loaded, so that setup.py and anything else
+    which just wants the lists of requirements can load it without packaging.
+
+    Requirements whose markers say they aren't needed in this environment are
+    left out, so that the markers are only evaluated once.
+
+    Returns:
+        tuple: the parsed forms of REQUIREMENTS, CONDITIONAL_REQUIREMENTS and
+            _ALL_OPTS. Each requirement is represented by a tuple of the original
+            specifier string, the name of the distribution, and the
+            packaging.specifiers.SpecifierSet its version must match.
     """
-    req = Requirement.parse(dependency_string)
+    from packaging.requirements import Requirement
 
-    # first check if the markers specify that this requirement needs installing
-    if req.marker is not None and not req.marker.evaluate():
-        # not required for this environment
-        return
+    parsed = {}
+    for s in itertools.chain(REQUIREMENTS, _ALL_OPTS):
+        req = Requirement(s)
+        if req.marker is None or req.marker.evaluate():
+            parsed[s] = (s, req.name, req.specifier)
+
+    def parse_list(dependency_strings):
+        return tuple(parsed[s] for s in dependency_strings if s in parsed)
+
+    return (
+        parse_list(REQUIREMENTS),
+        {name: parse_list(deps) for name, deps in CONDITIONAL_REQUIREMENTS.items()},
+        parse_list(_ALL_OPTS),
+    )
+
+
+def _get_installed_version(name):
+    """Gets the installed version of a distribution.
+
+    Args:
+        name (str): the name of the distribution
+
+    Returns:
+        str|None: its version, or None if it is not installed
+    """
+    # as with packaging, only import this when we need it.
+    try:
+        from importlib.metadata import PackageNotFoundError, version
+    except ImportError:
+        # importlib.metadata arrived in python 3.8
+        from importlib_metadata import PackageNotFoundError, version
 
-    get_provider(req)
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return None
 
 
 if __name__ == "__main__":
     import sys
 
-    sys.stdout.writelines(req + "\n" for req in list_requirements())
+    sys.stdout.write("\n".join(sorted(_ALL_REQUIREMENTS)) + "\n")
@@ -21,27 +21,33 @@ from .postgres import PostgresEngine
 from .sqlite import Sqlite3Engine
 from .cockroach import CockroachEngine
 
-SUPPORTED_MODULE = {
-    "sqlite3": Sqlite3Engine,
-    "psycopg2": PostgresEngine,
-    "cockroach": CockroachEngine
+# pypy requires psycopg2cffi rather than psycopg2
+_IS_PYPY = platform.python_implementation() == "PyPy"
+
+# Map from the database name in the config to the name of the driver module to
+# import, and the engine class to wrap it in.
+_ENGINES = {
+    "sqlite3": ("sqlite3", Sqlite3Engine),
+    "psycopg2": ("psycopg2cffi" if _IS_PYPY else "psycopg2", PostgresEngine),
+    "cockroach": ("psycopg2", CockroachEngine),
 }
 
+# The database driver modules we have imported, by name
+_MODULE_CACHE = {}
+
 
 def create_engine(database_config):
     name = database_config["name"]
-    engine_class = SUPPORTED_MODULE.get(name, None)
-
-    if engine_class:
-        # pypy requires psycopg2cffi rather than psycopg2
-        if name == "psycopg2" and platform.python_implementation() == "PyPy":
-            name = "psycopg2cffi"
-        elif name == "cockroach":
-            name = "psycopg2"
-        module = importlib.import_module(name)
-        return engine_class(module, database_config)
-
-    raise RuntimeError("Unsupported database engine '%s'" % (name,))
+
+    try:
+        module_name, engine_class = _ENGINES[name]
+    except KeyError:
+        raise RuntimeError("Unsupported database engine '%s'" % (name,))
+
+    module = _MODULE_CACHE.get(module_name)
+    if module is None:
+        module = _MODULE_CACHE[module_name] = importlib.import_module(module_name)
+    return engine_class(module, database_config)
 
 
 __all__ = ["create_engine", "IncorrectDatabaseSetup"]
@@ -13,7 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from synapse.config.server import is_threepid_reserved
+from synapse.config._base import ConfigError
+from synapse.config.server import ServerConfig, is_threepid_reserved
 
 from tests import unittest
 
@@ -29,3 +30,12 @@ class ServerConfigTestCase(unittest.TestCase):
         self.assertTrue(is_threepid_reserved(config, user1))
         self.assertFalse(is_threepid_reserved(config, user3))
         self.assertFalse(is_threepid_reserved(config, user1_msisdn))
+
+    def test_gzip_level(self):
+        config = ServerConfig()
+        config.read_config({"server_name": "test", "gzip_level": 6})
+        self.assertEqual(config.gzip_level, 6)
+
+        for level in (0, 10, "6", True):
+            with self.assertRaises(ConfigError):
+                ServerConfig().read_config({"server_name": "test", "gzip_level": level})
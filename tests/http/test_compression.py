@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import re
+import zlib
+
+from mock import Mock
+
+from twisted.web.resource import EncodingResourceWrapper
+
+from synapse.http.compression import (
+    THREADED_COMPRESSION_MIN_SIZE,
+    ThreadedGzipEncoderFactory,
+)
+from synapse.http.server import JsonResource
+from synapse.logging.context import LoggingContext
+from synapse.util import Clock
+
+from tests import unittest
+from tests.server import (
+    ThreadedMemoryReactorClock,
+    make_request,
+    render,
+    setup_test_homeserver,
+)
+
+
+class ThreadedGzipEncoderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reactor = ThreadedMemoryReactorClock()
+        self.hs_clock = Clock(self.reactor)
+        self.homeserver = setup_test_homeserver(
+            self.addCleanup, http_client=None, clock=self.hs_clock, reactor=self.reactor
+        )
+
+    def _make_request(self, response_body, accept_encoding=b"gzip"):
+        def _callback(request):
+            return 200, response_body
+
+        res = JsonResource(self.homeserver)
+        res.register_paths(
+            "GET", [re.compile("^/_matrix/foo$")], _callback, "test_servlet"
+        )
+        res = EncodingResourceWrapper(
+            res, [ThreadedGzipEncoderFactory(self.reactor, 1)]
+        )
+
+        request, channel = make_request(self.reactor, b"GET", b"/_matrix/foo")
+        request.requestHeaders.addRawHeader(b"Accept-Encoding", accept_encoding)
+
+        # make_request stubs out Request.process, which is where twisted would
+        # normally pick the encoder.
+        request._encoder = res.getEncoder(request)
+        return res, request, channel
+
+    def _get_response(self, response_body, accept_encoding=b"gzip"):
+        res, request, channel = self._make_request(response_body, accept_encoding)
+        render(request, res, self.reactor)
+
+        self.assertEqual(channel.code, 200)
+        return channel
+
+    def _assert_gzipped(self, channel, expected_body):
+        self.assertEqual(channel.headers.getRawHeaders(b"Content-Encoding"), [b"gzip"])
+        self.assertIsNone(channel.headers.getRawHeaders(b"Content-Length"))
+        body = zlib.decompress(channel.result["body"], 16 + zlib.MAX_WBITS)
+        self.assertEqual(json.loads(body.decode("utf8")), expected_body)
+
+    def test_small_response(self):
+        """Small responses are compressed inline."""
+        response_body = {"foo": "bar"}
+        channel = self._get_response(response_body)
+        self._assert_gzipped(channel, response_body)
+
+    def test_large_response(self):
+        """Large responses are compressed on the threadpool, and the request is
+        only finished once they have been written.
+        """
+        response_body = {"foo": "x" * (3 * THREADED_COMPRESSION_MIN_SIZE)}
+        channel = self._get_response(response_body)
+        self._assert_gzipped(channel, response_body)
+
+    def test_compression_logcontext(self):
+        """Compression on the threadpool is done in a child of the request's
+        logcontext.
+        """
+        response_body = {"foo": "x" * (3 * THREADED_COMPRESSION_MIN_SIZE)}
+        res, request, channel = self._make_request(response_body)
+
+        contexts = []
+        compressor = request._encoder._compressor
+
+        def compress(data):
+            contexts.append(LoggingContext.current_context())
+            return compressor.compress(data)
+
+        request._encoder._compressor = Mock(compress=compress, flush=compressor.flush)
+        render(request, res, self.reactor)
+
+        self.assertEqual(channel.code, 200)
+        self.assertTrue(contexts)
+        for context in contexts:
+            self.assertIs(context.parent_context, request.logcontext)
+
+    def test_not_accepted(self):
+        """Clients which don't ask for gzip get an uncompressed response."""
+        response_body = {"foo": "bar"}
+        channel = self._get_response(response_body, accept_encoding=b"identity")
+        self.assertIsNone(channel.headers.getRawHeaders(b"Content-Encoding"))
+        self.assertEqual(channel.json_body, response_body)
+
+    def _pump(self):
+        # give the producer time to write out the whole response
+        for _ in range(20):
+            self.reactor.advance(0.1)
+
+    def test_compression_error(self):
+        """If compressing the response fails, the connection is dropped, and the
+        response isn't finished.
+        """
+        response_body = {"foo": "x" * (3 * THREADED_COMPRESSION_MIN_SIZE)}
+        res, request, channel = self._make_request(response_body)
+        channel.loseConnection = Mock()
+
+        compressor = request._encoder._compressor
+        request._encoder._compressor = Mock(
+            compress=Mock(side_effect=Exception("compress failed")),
+            flush=compressor.flush,
+        )
+
+        request.render(res)
+        self._pump()
+
+        channel.loseConnection.assert_called_once_with()
+        self.assertFalse(request.finished)
+
+    def test_write_error(self):
+        """If writing out compressed data fails, the connection is dropped, and the
+        rest of the response is discarded.
+        """
+        response_body = {"foo": "x" * (3 * THREADED_COMPRESSION_MIN_SIZE)}
+        res, request, channel = self._make_request(response_body)
+        channel.loseConnection = Mock()
+        channel.write = Mock(side_effect=Exception("write failed"))
+
+        request.render(res)
+        self._pump()
+
+        channel.loseConnection.assert_called_once_with()
+        channel.write.assert_called_once()
+        self.assertFalse(request.finished)
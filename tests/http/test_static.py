@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from twisted.web.resource import getChildForRequest
+
+from synapse.http.static import CachingFile, ScandirFile
+
+from tests import unittest
+from tests.server import ThreadedMemoryReactorClock, make_request, render
+
+
+class CachingFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reactor = ThreadedMemoryReactorClock()
+
+        self.static_dir = tempfile.mkdtemp(prefix="synapse-tests-")
+        self.addCleanup(shutil.rmtree, self.static_dir)
+
+        with open(os.path.join(self.static_dir, "index.html"), "wb") as f:
+            f.write(b"<html></html>")
+
+    def _get(self, path, headers={}):
+        request, channel = make_request(self.reactor, b"GET", path, shorthand=False)
+        for name, value in headers.items():
+            request.requestHeaders.addRawHeader(name, value)
+
+        fpath = os.path.join(self.static_dir, "index.html")
+        render(request, CachingFile(fpath), self.reactor)
+        return channel
+
+    def test_cache_headers(self):
+        channel = self._get(b"/_matrix/static/index.html")
+        self.assertEqual(channel.code, 200)
+        self.assertEqual(channel.result["body"], b"<html></html>")
+        self.assertEqual(
+            channel.headers.getRawHeaders(b"Cache-Control"), [b"public, max-age=3600"]
+        )
+        self.assertIsNotNone(channel.headers.getRawHeaders(b"ETag"))
+
+    def test_hashed_path(self):
+        channel = self._get(b"/_matrix/static/bundles/0123456789abcdef0123/index.html")
+        self.assertEqual(
+            channel.headers.getRawHeaders(b"Cache-Control"),
+            [b"public, max-age=31536000, immutable"],
+        )
+
+    def test_if_none_match(self):
+        channel = self._get(b"/_matrix/static/index.html")
+        etag = channel.headers.getRawHeaders(b"ETag")[0]
+
+        channel = self._get(b"/_matrix/static/index.html", {b"If-None-Match": etag})
+        self.assertEqual(channel.code, 304)
+        self.assertNotIn("body", channel.result)
+
+
+class ScandirFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reactor = ThreadedMemoryReactorClock()
+
+        self.static_dir = tempfile.mkdtemp(prefix="synapse-tests-")
+        self.addCleanup(shutil.rmtree, self.static_dir)
+
+        os.mkdir(os.path.join(self.static_dir, "sub"))
+        self._write_file("sub/index.html", b"<html></html>")
+
+        self.resource = ScandirFile(self.static_dir)
+
+    def _write_file(self, path, content):
+        with open(os.path.join(self.static_dir, path), "wb") as f:
+            f.write(content)
+
+    def _get(self, path):
+        request, channel = make_request(self.reactor, b"GET", path, shorthand=False)
+        # make_request stubs out Request.process, which would normally set this up
+        request.prepath = []
+        render(request, getChildForRequest(self.resource, request), self.reactor)
+        return channel
+
+    def test_get_file(self):
+        channel = self._get(b"/sub/index.html")
+        self.assertEqual(channel.code, 200)
+        self.assertEqual(channel.result["body"], b"<html></html>")
+
+        # the resources are reused for the next request
+        sub = self.resource.getChild(b"sub", None)
+        self.assertIs(sub, self.resource.getChild(b"sub", None))
+
+    def test_new_file(self):
+        """Files created after a directory was listed are still served."""
+        self._get(b"/sub/index.html")
+
+        self._write_file("sub/new.html", b"<html>new</html>")
+        channel = self._get(b"/sub/new.html")
+        self.assertEqual(channel.code, 200)
+        self.assertEqual(channel.result["body"], b"<html>new</html>")
+
+    def test_deleted_file(self):
+        self._get(b"/sub/index.html")
+
+        os.unlink(os.path.join(self.static_dir, "sub", "index.html"))
+        channel = self._get(b"/sub/index.html")
+        self.assertEqual(channel.code, 404)
+
+    def test_missing_file(self):
+        channel = self._get(b"/sub/missing.html")
+        self.assertEqual(channel.code, 404)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+from mock import Mock, patch
+
+from synapse import python_dependencies
+from synapse.python_dependencies import (
+    DependencyException,
+    _get_installed_version,
+    check_requirements,
+)
+
+from tests import unittest
+
+
+class CheckRequirementsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.installed_versions = {}
+
+        self._patch("REQUIREMENTS", ["foo>=1.0", 'bar>=2.0;python_version<"3"'])
+        self._patch(
+            "CONDITIONAL_REQUIREMENTS", {"feat": ["baz>=3.0"], "other": ["qux>=4.0"]}
+        )
+        self._patch("_ALL_OPTS", ("baz>=3.0", "qux>=4.0"))
+        self._patch("_satisfied_features", set())
+
+        env_patcher = patch.dict(os.environ)
+        env_patcher.start()
+        self.addCleanup(env_patcher.stop)
+        os.environ.pop("SYNAPSE_SKIP_DEPENDENCY_CHECK", None)
+
+        self._patch(
+            "_get_installed_version",
+            Mock(side_effect=lambda name: self.installed_versions.get(name)),
+        )
+
+        # the parsed forms of the requirements are cached, so make sure we parse
+        # the patched ones, and don't leave them behind for anything else.
+        python_dependencies._parse_requirements.cache_clear()
+        self.addCleanup(python_dependencies._parse_requirements.cache_clear)
+
+    def _patch(self, name, value):
+        patcher = patch.object(python_dependencies, name, value)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_satisfied(self):
+        self.installed_versions = {"foo": "1.2", "baz": "3.0"}
+        check_requirements()
+
+    def test_missing(self):
+        with self.assertRaises(DependencyException) as cm:
+            check_requirements()
+        self.assertEqual(cm.exception.dependencies, ["'foo>=1.0'"])
+        self.assertIn("pip install --upgrade --force 'foo>=1.0'", cm.exception.message)
+
+    def test_version_conflict(self):
+        self.installed_versions = {"foo": "0.9"}
+        with self.assertLogs("synapse.python_dependencies") as logs:
+            with self.assertRaises(DependencyException) as cm:
+                check_requirements()
+        self.assertEqual(cm.exception.dependencies, ["'foo>=1.0'"])
+        self.assertIn("Needed foo>=1.0, got foo==0.9", logs.output[0])
+
+    def test_optional_version_conflict(self):
+        """Optional requirements which are installed must have the right version."""
+        self.installed_versions = {"foo": "1.0", "qux": "3.9"}
+        with self.assertRaises(DependencyException) as cm:
+            check_requirements()
+        self.assertEqual(cm.exception.dependencies, ["'qux>=4.0'"])
+
+    def test_optional_not_installed(self):
+        self.installed_versions = {"foo": "1.0"}
+        check_requirements()
+
+    def test_prerelease(self):
+        self.installed_versions = {"foo": "1.1rc1"}
+        check_requirements()
+
+    def test_only_requirements_looked_up(self):
+        self.installed_versions = {"baz": "3.0"}
+        check_requirements("feat")
+        python_dependencies._get_installed_version.assert_called_once_with("baz")
+
+    def test_marker_not_applicable(self):
+        """bar isn't needed on python 3, so isn't reported as missing."""
+        self.installed_versions = {"foo": "1.0"}
+        check_requirements()
+
+    def test_feature(self):
+        self.installed_versions = {"baz": "3.0"}
+        check_requirements("feat")
+
+        with self.assertRaises(DependencyException) as cm:
+            check_requirements("other")
+        self.assertEqual(cm.exception.dependencies, ["'qux>=4.0'"])
+
+    def test_feature_success_remembered(self):
+        self.installed_versions = {"baz": "3.0"}
+        check_requirements("feat")
+
+        # even though baz has now gone, the check isn't repeated.
+        self.installed_versions = {}
+        check_requirements("feat")
+
+    def test_feature_failure_not_remembered(self):
+        with self.assertRaises(DependencyException):
+            check_requirements("feat")
+
+        self.installed_versions = {"baz": "3.0"}
+        check_requirements("feat")
+
+    def test_skip_check(self):
+        os.environ["SYNAPSE_SKIP_DEPENDENCY_CHECK"] = "1"
+        check_requirements()
+        check_requirements("feat")
+        python_dependencies._get_installed_version.assert_not_called()
+
+
+class GetInstalledVersionTestCase(unittest.TestCase):
+    def test_installed(self):
+        self.assertIsNotNone(_get_installed_version("Twisted"))
+
+    def test_not_installed(self):
+        self.assertIsNone(_get_installed_version("not-a-real-distribution"))